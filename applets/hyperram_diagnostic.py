@@ -22,6 +22,10 @@ from luna.gateware.interface.psram    import HyperRAMInterface
 
 REGISTER_RAM_REG_ADDR   = 2
 REGISTER_RAM_VALUE      = 3
+REGISTER_RAM_READY      = 4
+
+# The number of times we'll poll for a completed read before considering it failed.
+READ_POLL_ATTEMPTS      = 100
 
 
 class HyperRAMDiagnostic(Elaboratable):
@@ -37,7 +41,9 @@ class HyperRAMDiagnostic(Elaboratable):
         clocking = LunaECP5DomainGenerator()
         m.submodules.clocking = clocking
 
-        # Grab a reference to our debug-SPI bus.
+        # Grab a reference to our debug-SPI bus. Our register interface oversamples the bus in the
+        # `sync` domain, so each line gets an identical synchronizer chain; this keeps SCK and SDI
+        # aligned relative to each other, with data sampled well after it's settled.
         board_spi = synchronize(m, platform.request("debug_spi"))
 
         # Create a set of registers...
@@ -50,21 +56,34 @@ class HyperRAMDiagnostic(Elaboratable):
         # HyperRAM test connections.
         #
         ram_bus = platform.request('ram')
-        psram = HyperRAMInterface(bus=ram_bus, **platform.ram_timings)
+        psram = HyperRAMInterface(bus=ram_bus, **platform.ram_timings,
+            register_space=1, perform_write=0, single_page=0, final_word=1)
         m.submodules += psram
 
         psram_address_changed = Signal()
         psram_address = spi_registers.add_register(REGISTER_RAM_REG_ADDR, write_strobe=psram_address_changed)
 
-        spi_registers.add_sfr(REGISTER_RAM_VALUE, read=psram.read_data)
+        # Capture each word read from the PSRAM once it's complete; so our register always presents a
+        # full word, rather than one whose bytes are being updated underneath it.
+        psram_read_data = Signal.like(psram.read_data)
+        with m.If(psram.new_data_ready):
+            m.d.sync += psram_read_data.eq(psram.read_data)
+
+        spi_registers.add_sfr(REGISTER_RAM_VALUE, read=psram_read_data)
+
+        # Provide a status bit that lets the host know when a read has completed.
+        psram_data_ready = Signal()
+        spi_registers.add_sfr(REGISTER_RAM_READY, read=psram_data_ready)
 
-        # Hook up our PSRAM.
+        with m.If(psram.new_data_ready):
+            m.d.sync += psram_data_ready.eq(1)
+        with m.Elif(psram_address_changed):
+            m.d.sync += psram_data_ready.eq(0)
+
+        # Hook up our PSRAM. We only perform single-word register reads, so our other transfer
+        # options are fixed when we create our interface, above.
         m.d.comb += [
             ram_bus.reset          .eq(0),
-            psram.single_page      .eq(0),
-            psram.perform_write    .eq(0),
-            psram.register_space   .eq(1),
-            psram.final_word       .eq(1),
             psram.start_transfer   .eq(psram_address_changed),
             psram.address          .eq(psram_address),
         ]
@@ -87,14 +106,26 @@ if __name__ == "__main__":
     failures = 0
     failed_tests = set()
 
+    def wait_for_read():
+        """ Waits for a HyperRAM read to complete; returns False if it never does. """
+        for _ in range(READ_POLL_ATTEMPTS):
+            if debugger.spi.register_read(REGISTER_RAM_READY) & 1:
+                return True
+
+        return False
+
     def test_id_read():
         debugger.spi.register_write(REGISTER_RAM_REG_ADDR, 0x0)
         debugger.spi.register_write(REGISTER_RAM_REG_ADDR, 0x0)
+        if not wait_for_read():
+            return False
         return debugger.spi.register_read(REGISTER_RAM_VALUE) == 0x0c81
 
     def test_config_read():
         debugger.spi.register_write(REGISTER_RAM_REG_ADDR, 0x800)
         debugger.spi.register_write(REGISTER_RAM_REG_ADDR, 0x800)
+        if not wait_for_read():
+            return False
         return debugger.spi.register_read(REGISTER_RAM_VALUE) == 0x8f1f
 
     # Run each of our tests.
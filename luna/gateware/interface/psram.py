@@ -8,7 +8,7 @@
 
 import unittest
 
-from nmigen import Signal, Module, Cat, Elaboratable, Record, ClockDomain, ClockSignal
+from nmigen import Signal, Module, Cat, Const, Elaboratable, Record, ClockDomain, ClockSignal
 from nmigen.hdl.rec import DIR_FANIN, DIR_FANOUT
 
 from ..utils.io   import delay
@@ -62,13 +62,19 @@ class HyperRAMInterface(Elaboratable):
     LOW_LATENCY_EDGES  = 6
     HIGH_LATENCY_EDGES = 14
 
-    def __init__(self, *, bus, in_skew=None, out_skew=None, clock_skew=None):
+    def __init__(self, *, bus, in_skew=None, out_skew=None, clock_skew=None,
+            register_space=None, perform_write=None, single_page=None, final_word=None):
         """
         Parmeters:
             bus           -- The RAM record that should be connected to this RAM chip.
             data_skews    -- If provided, adds an input delay to each line of the data input.
                              Can be provided as a single delay number, or an interable of eight
                              delays to separately delay each of the input lines.
+
+            register_space, perform_write, single_page, final_word --
+                             If provided, fixes the relevant control input to the given value.
+                             The matching attribute becomes a constant rather than an input; which
+                             allows the logic for any unused modes to be optimized away.
         """
 
         self.in_skew    = in_skew
@@ -83,11 +89,11 @@ class HyperRAMInterface(Elaboratable):
 
         # Control signals.
         self.address          = Signal(32)
-        self.register_space   = Signal()
-        self.perform_write    = Signal()
-        self.single_page      = Signal()
+        self.register_space   = self._control_input(register_space, name="register_space")
+        self.perform_write    = self._control_input(perform_write, name="perform_write")
+        self.single_page      = self._control_input(single_page, name="single_page")
         self.start_transfer   = Signal()
-        self.final_word       = Signal()
+        self.final_word       = self._control_input(final_word, name="final_word")
 
         # Status signals.
         self.idle             = Signal()
@@ -98,6 +104,12 @@ class HyperRAMInterface(Elaboratable):
         self.write_data       = Signal(16)
 
 
+    @staticmethod
+    def _control_input(fixed_value, *, name):
+        """ Creates a control input; or a constant, if the control has been fixed to a given value. """
+        return Signal(name=name) if fixed_value is None else Const(fixed_value, 1)
+
+
     def elaborate(self, platform):
         m = Module()
 
@@ -138,10 +150,24 @@ class HyperRAMInterface(Elaboratable):
         #
         # Latched control/addressing signals.
         #
-        is_read         = Signal()
-        is_register     = Signal()
         current_address = Signal(32)
-        is_multipage    = Signal()
+        latched_controls = []
+
+        def latch_control(control):
+            """ Returns a register that captures the given control at the start of a transfer.
+
+            If the control is fixed, it's returned directly; there's no need to latch a constant.
+            """
+            if isinstance(control, Const):
+                return control
+
+            latched = Signal.like(control, name_suffix="_latched")
+            latched_controls.append(latched.eq(control))
+            return latched
+
+        is_write        = latch_control(self.perform_write)
+        is_register     = latch_control(self.register_space)
+        is_single_page  = latch_control(self.single_page)
 
         #
         # FSM datapath signals.
@@ -193,9 +219,7 @@ class HyperRAMInterface(Elaboratable):
                     m.next = 'LATCH_RWDS'
 
                     m.d.sync += [
-                        is_read          .eq(~self.perform_write),
-                        is_register      .eq(self.register_space),
-                        is_multipage     .eq(~self.single_page),
+                        *latched_controls,
                         current_address  .eq(self.address),
                     ]
 
@@ -232,9 +256,9 @@ class HyperRAMInterface(Elaboratable):
                 # Build our composite command byte.
                 command_byte = Cat(
                     current_address[27:32],
-                    is_multipage,
+                    ~is_single_page,
                     is_register,
-                    is_read
+                    ~is_write
                 )
 
                 # Output our first byte of our command.
@@ -284,7 +308,7 @@ class HyperRAMInterface(Elaboratable):
 
                 # If we have a register write, we don't need to handle
                 # any latency. Move directly to our SHIFT_DATA state.
-                with m.If(is_register & ~is_read):
+                with m.If(is_register & is_write):
                     m.next = 'WRITE_DATA_MSB'
 
                 # Otherwise, react with either a short period of latency
@@ -304,7 +328,7 @@ class HyperRAMInterface(Elaboratable):
                 m.d.sync += latency_edges_remaining.eq(latency_edges_remaining - 1)
 
                 with m.If(latency_edges_remaining == 0):
-                    with m.If(is_read):
+                    with m.If(~is_write):
                         m.next = 'READ_DATA_MSB'
                     with m.Else():
                         m.next = 'WRITE_DATA_MSB'
@@ -360,6 +384,9 @@ class HyperRAMInterface(Elaboratable):
 
 class TestHyperRAMInterface(LunaGatewareTestCase):
 
+    # Any transfer options to fix when creating our interface.
+    FIXED_OPTIONS = {}
+
     def instantiate_dut(self):
         # Create a record that recreates the layout of our RAM signals.
         self.ram_signals = Record([
@@ -372,7 +399,14 @@ class TestHyperRAMInterface(LunaGatewareTestCase):
         ])
 
         # Create our HyperRAM interface...
-        return HyperRAMInterface(bus=self.ram_signals)
+        return HyperRAMInterface(bus=self.ram_signals, **self.FIXED_OPTIONS)
+
+
+    def request_register_read(self):
+        """ Configures our interface for a single-word register read. """
+        yield self.dut.perform_write  .eq(0)
+        yield self.dut.register_space .eq(1)
+        yield self.dut.final_word     .eq(1)
 
 
     def assert_clock_pulses(self, times=1):
@@ -399,11 +433,9 @@ class TestHyperRAMInterface(LunaGatewareTestCase):
         self.assertEqual((yield self.ram_signals.cs),      0)
 
         # Request a register read of ID register 0.
-        yield self.dut.perform_write  .eq(0)
-        yield self.dut.register_space .eq(1)
+        yield from self.request_register_read()
         yield self.dut.address        .eq(0x00BBCCDD)
         yield self.dut.start_transfer .eq(1)
-        yield self.dut.final_word     .eq(1)
 
         # Simulate the RAM requesting a extended latency.
         yield self.ram_signals.rwds.i .eq(1)
@@ -494,6 +526,17 @@ class TestHyperRAMInterface(LunaGatewareTestCase):
         # TODO: test recovery time
 
 
+
+class TestFixedModeHyperRAMInterface(TestHyperRAMInterface):
+    """ Runs our HyperRAM tests with the interface's transfer options fixed at construction. """
+
+    FIXED_OPTIONS = {'register_space': 1, 'perform_write': 0, 'single_page': 0, 'final_word': 1}
+
+    def request_register_read(self):
+        # Our interface is already fixed to perform single-word register reads.
+        yield from ()
+
+
 if __name__ == "__main__":
     unittest.main()
 
@@ -10,11 +10,14 @@ This module contains definitions of memory units that work well for USB applicat
 
 import unittest
 
-from nmigen import Elaboratable, Module, Signal, Memory
-from nmigen.hdl.xfrm import DomainRenamer
+from nmigen             import Elaboratable, Module, Signal, Memory, Const, Cat, Mux
+from nmigen.hdl.xfrm    import DomainRenamer
+from nmigen.lib.cdc     import FFSynchronizer
+from nmigen.lib.coding  import GrayDecoder
+from nmigen.utils       import bits_for, log2_int
 
 
-from .test import LunaGatewareTestCase, sync_test_case
+from .test import LunaGatewareTestCase, sync_test_case, usb_domain_test_case
 
 
 class TransactionalizedFIFO(Elaboratable):
@@ -107,13 +110,21 @@ class TransactionalizedFIFO(Elaboratable):
     def elaborate(self, platform):
         m = Module()
 
-        # Range shortcuts for internal signals.
-        address_range = range(0, self.depth + 1)
+        # Our memory holds exactly ``depth`` entries; so e.g. a 1024-entry FIFO fits exactly into a
+        # single block RAM. To tell a full FIFO from an empty one, each of our pointers carries an extra
+        # "lap" bit above its address; which flips each time the pointer wraps around our memory.
+        address_width = bits_for(self.depth - 1)
+        pointer_width = address_width + 1
+
+        def advance(pointer):
+            """ Returns the value our pointer should take after moving to the next entry. """
+            return Mux(pointer[:-1] == self.depth - 1, Cat(Const(0, address_width), ~pointer[-1]), pointer + 1)
+
 
         #
         # Core internal "backing store".
         #
-        memory = Memory(width=self.width, depth=self.depth + 1, name=self.name)
+        memory = Memory(width=self.width, depth=self.depth, name=self.name)
         m.submodules.read_port  = read_port  = memory.read_port()
         m.submodules.write_port = write_port = memory.write_port()
 
@@ -131,16 +142,13 @@ class TransactionalizedFIFO(Elaboratable):
 
         # We'll track two pieces of data: our _committed_ write position, and our current un-committed write one.
         # This will allow us to rapidly backtrack to our pre-commit position.
-        committed_write_pointer = Signal(address_range)
-        current_write_pointer   = Signal(address_range)
-        m.d.comb += write_port.addr.eq(current_write_pointer)
+        committed_write_pointer = Signal(pointer_width)
+        current_write_pointer   = Signal(pointer_width)
+        m.d.comb += write_port.addr.eq(current_write_pointer[:-1])
 
         # If we're writing to the fifo, update our current write position.
         with m.If(self.write_en & ~self.full):
-            with m.If(current_write_pointer == self.depth):
-                m.d.sync += current_write_pointer.eq(0)
-            with m.Else():
-                m.d.sync += current_write_pointer.eq(current_write_pointer + 1)
+            m.d.sync += current_write_pointer.eq(advance(current_write_pointer))
 
         # If we're committing a FIFO write, update our committed position.
         with m.If(self.write_commit):
@@ -157,26 +165,23 @@ class TransactionalizedFIFO(Elaboratable):
 
         # We'll track two pieces of data: our _committed_ read position, and our current un-committed read one.
         # This will allow us to rapidly backtrack to our pre-commit position.
-        committed_read_pointer = Signal(address_range)
-        current_read_pointer   = Signal(address_range)
+        committed_read_pointer = Signal(pointer_width)
+        current_read_pointer   = Signal(pointer_width)
 
 
         # Compute the location for the next read, accounting for wraparound. We'll not assume a binary-sized
         # buffer; so we'll compute the wraparound manually.
         next_read_pointer      = Signal.like(current_read_pointer)
-        with m.If(current_read_pointer == self.depth):
-            m.d.comb += next_read_pointer.eq(0)
-        with m.Else():
-            m.d.comb += next_read_pointer.eq(current_read_pointer + 1)
+        m.d.comb += next_read_pointer.eq(advance(current_read_pointer))
 
 
         # Our memory always takes a single cycle to provide its read output; so we'll update its address
         # "one cycle in advance". Accordingly, if we're about to advance the FIFO, we'll use the next read
         # address as our input. If we're not, we'll use the current one.
         with m.If(self.read_en & ~self.empty):
-            m.d.comb += read_port.addr.eq(next_read_pointer)
+            m.d.comb += read_port.addr.eq(next_read_pointer[:-1])
         with m.Else():
-            m.d.comb += read_port.addr.eq(current_read_pointer)
+            m.d.comb += read_port.addr.eq(current_read_pointer[:-1])
 
 
         # If we're reading from our the fifo, update our current read position.
@@ -201,17 +206,19 @@ class TransactionalizedFIFO(Elaboratable):
         m.d.comb += self.empty.eq(current_read_pointer == committed_write_pointer)
 
         # For our space available, we'll use the current write position (which leads ahead) and our committed
-        # read position (which lags behind). This yields two cases: one where the buffer isn't wrapped around,
-        # and one where it is.
-        with m.If(self.full):
-            m.d.comb += self.space_available.eq(0)
-        with m.Elif(committed_read_pointer <= current_write_pointer):
-            m.d.comb += self.space_available.eq(self.depth - (current_write_pointer - committed_read_pointer))
+        # read position (which lags behind). This yields two cases: one where both pointers are on the same
+        # lap around our memory, and one where our write pointer has wrapped around ahead of our read pointer.
+        write_address = current_write_pointer[:-1]
+        read_address  = committed_read_pointer[:-1]
+        with m.If(current_write_pointer[-1] == committed_read_pointer[-1]):
+            m.d.comb += self.space_available.eq(self.depth - (write_address - read_address))
         with m.Else():
-            m.d.comb += self.space_available.eq(committed_read_pointer - current_write_pointer - 1)
+            m.d.comb += self.space_available.eq(read_address - write_address)
 
-        # Our FIFO is full if we don't have any space available.
-        m.d.comb += self.full.eq(current_write_pointer + 1 == committed_read_pointer)
+        # Our FIFO is full if our write pointer is a full lap ahead of our read pointer.
+        m.d.comb += self.full.eq(
+            (write_address == read_address) & (current_write_pointer[-1] != committed_read_pointer[-1])
+        )
 
 
         # If we're not supposed to be in the sync domain, rename our sync domain to the target.
@@ -222,6 +229,238 @@ class TransactionalizedFIFO(Elaboratable):
 
 
 
+
+class AsyncTransactionalizedFIFO(Elaboratable):
+    """ Transactionalized, buffered first-in-first-out queue with independent read and write clocks.
+
+    This FIFO has the same interface and commit/discard semantics as :class:`TransactionalizedFIFO`; but its
+    read port lives in a different clock domain than its write port. Committed read and write positions are
+    passed between domains as Gray-coded pointers; so the backing store can be inferred as a simple dual-port,
+    dual-clock block RAM.
+
+    Committed positions are published to the opposite domain one entry per cycle. Accordingly, a large commit
+    becomes visible to the other side of the FIFO over several cycles, rather than all at once; and each side
+    may briefly underestimate the data or space available.
+
+    Attributes
+    ----------
+    read_data: Signal(width), output
+        Contains the next entry in the FIFO. Valid only when :attr:``empty`` is false.
+    read_en: Signal(), input
+        When asserted, :attr:``read_data`` will move to the next entry. Reads are not finalized until
+        :attr:``read_commit`` is asserted; and can be undone with :attr:``read_discard``.
+    read_commit: Signal(), input
+        Strobe; when asserted, all reads since the last commit are finalized, freeing their space for writing.
+        Tying this to '1' makes the read port behave as a normal, non-transactionalized port.
+    read_discard: Signal(), input
+        Strobe; when asserted, all reads since the last commit are undone.
+    empty: Signal(), output
+        Asserted when no committed data is available to read.
+
+    write_data: Signal(width), input
+        Holds the entry to be added to the FIFO when :attr:``write_en`` is asserted.
+    write_en: Signal(), input
+        When asserted, :attr:``write_data`` is added to the FIFO. Written data is not available for reading
+        until :attr:``write_commit`` is asserted; and can be undone with :attr:``write_discard``.
+    write_commit: Signal(), input
+        Strobe; when asserted, all writes since the last commit are finalized, making them available to read.
+    write_discard: Signal(), input
+        Strobe; when asserted, all writes since the last commit are undone, freeing their space.
+    full: Signal(), output
+        Asserted when no space is available for writes.
+    space_available: Signal(range(0, depth + 1)), output
+        Indicates the amount of space available for writes.
+
+    The ``read_*`` signals and :attr:``empty`` belong to the read domain; all others belong to the write domain.
+
+
+    Parameters
+    ----------
+    width: int
+        The width of each entry in the FIFO.
+    depth: int
+        The number of allowed entries in the FIFO. Must be a power of two.
+    name: str
+        The name of the relevant FIFO; to produce nicer debug output.
+        If not provided, nMigen will attempt auto-detection.
+    w_domain: str
+        The name of the domain the FIFO's write port should exist in.
+    r_domain: str
+        The name of the domain the FIFO's read port should exist in.
+    """
+
+    def __init__(self, *, width, depth, name=None, w_domain="sync", r_domain="sync"):
+
+        if (depth < 2) or (depth & (depth - 1)):
+            raise ValueError(f"asynchronous FIFO depth must be a power of two, not {depth}")
+
+        self.width    = width
+        self.depth    = depth
+        self.name     = name
+        self.w_domain = w_domain
+        self.r_domain = r_domain
+
+        #
+        # I/O port
+        #
+        self.read_data        = Signal(width)
+        self.read_en          = Signal()
+        self.read_commit      = Signal()
+        self.read_discard     = Signal()
+        self.empty            = Signal()
+
+        self.write_data       = Signal(width)
+        self.write_en         = Signal()
+        self.write_commit     = Signal()
+        self.write_discard    = Signal()
+        self.full             = Signal()
+
+        self.space_available  = Signal(range(0, depth + 1))
+
+
+    def _publish_pointer(self, m, pointer, *, i_domain, o_domain):
+        """ Makes a committed pointer visible in another domain, returning the synchronized pointer.
+
+        The published pointer steps towards ``pointer`` one entry per cycle; which ensures only a single bit
+        of its Gray-coded representation changes at a time, and thus that it can be safely synchronized.
+        """
+
+        published_pointer = Signal.like(pointer)
+        next_pointer      = Signal.like(pointer)
+        published_gray    = Signal.like(pointer)
+        synchronized_gray = Signal.like(pointer)
+
+        with m.If(published_pointer != pointer):
+            m.d.comb += next_pointer.eq(published_pointer + 1)
+        with m.Else():
+            m.d.comb += next_pointer.eq(published_pointer)
+
+        # Register both our binary and Gray pointers; so the signal we synchronize never glitches.
+        m.d[i_domain] += [
+            published_pointer  .eq(next_pointer),
+            published_gray     .eq(next_pointer ^ next_pointer[1:]),
+        ]
+        m.submodules += FFSynchronizer(published_gray, synchronized_gray, o_domain=o_domain)
+
+        # Finally, convert our pointer back into binary on the far side of our synchronizer.
+        decoder = GrayDecoder(len(pointer))
+        m.submodules += decoder
+        m.d.comb += decoder.i.eq(synchronized_gray)
+
+        return decoder.o
+
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Our pointers carry a single bit above their address; which flips each time they wrap around our memory.
+        # This lets us tell a full FIFO from an empty one.
+        pointer_width = log2_int(self.depth) + 1
+
+        #
+        # Core internal "backing store".
+        #
+        memory = Memory(width=self.width, depth=self.depth, name=self.name)
+        m.submodules.read_port  = read_port  = memory.read_port(domain=self.r_domain, transparent=False)
+        m.submodules.write_port = write_port = memory.write_port(domain=self.w_domain)
+
+        # Always connect up our memory's data/en ports to ours.
+        m.d.comb += [
+            self.read_data  .eq(read_port.data),
+
+            write_port.data .eq(self.write_data),
+            write_port.en   .eq(self.write_en & ~self.full)
+        ]
+
+        #
+        # Write port.
+        #
+
+        # We'll track two pieces of data: our _committed_ write position, and our current un-committed write one.
+        # This will allow us to rapidly backtrack to our pre-commit position.
+        committed_write_pointer = Signal(pointer_width)
+        current_write_pointer   = Signal(pointer_width)
+        m.d.comb += write_port.addr.eq(current_write_pointer[:-1])
+
+        # If we're writing to the FIFO, update our current write position.
+        with m.If(self.write_en & ~self.full):
+            m.d[self.w_domain] += current_write_pointer.eq(current_write_pointer + 1)
+
+        # If we're committing a FIFO write, update our committed position.
+        with m.If(self.write_commit):
+            m.d[self.w_domain] += committed_write_pointer.eq(current_write_pointer)
+
+        # If we're discarding our current write, return to our committed position.
+        with m.If(self.write_discard):
+            m.d[self.w_domain] += current_write_pointer.eq(committed_write_pointer)
+
+
+        #
+        # Read port.
+        #
+
+        # We'll track two pieces of data: our _committed_ read position, and our current un-committed read one.
+        # This will allow us to rapidly backtrack to our pre-commit position.
+        committed_read_pointer = Signal(pointer_width)
+        current_read_pointer   = Signal(pointer_width)
+        next_read_pointer      = Signal(pointer_width)
+        m.d.comb += next_read_pointer.eq(current_read_pointer + 1)
+
+        # Our memory always takes a single cycle to provide its read output; so we'll update its address
+        # "one cycle in advance". Accordingly, if we're about to advance the FIFO, we'll use the next read
+        # address as our input. If we're not, we'll use the current one.
+        with m.If(self.read_en & ~self.empty):
+            m.d.comb += read_port.addr.eq(next_read_pointer[:-1])
+        with m.Else():
+            m.d.comb += read_port.addr.eq(current_read_pointer[:-1])
+
+
+        # If we're reading from the FIFO, update our current read position.
+        with m.If(self.read_en & ~self.empty):
+            m.d[self.r_domain] += current_read_pointer.eq(next_read_pointer)
+
+        # If we're committing a FIFO read, update our committed position.
+        with m.If(self.read_commit):
+            m.d[self.r_domain] += committed_read_pointer.eq(current_read_pointer)
+
+        # If we're discarding our current read, return to our committed position.
+        with m.If(self.read_discard):
+            m.d[self.r_domain] += current_read_pointer.eq(committed_read_pointer)
+
+
+        #
+        # Clock domain crossing.
+        #
+
+        # Each side of our FIFO sees a (slightly delayed) copy of the other side's committed position.
+        # These lag behind the true positions; which means each side only ever underestimates what's available.
+        write_pointer_in_read_domain = self._publish_pointer(m, committed_write_pointer,
+            i_domain=self.w_domain, o_domain=self.r_domain)
+        read_pointer_in_write_domain = self._publish_pointer(m, committed_read_pointer,
+            i_domain=self.r_domain, o_domain=self.w_domain)
+
+
+        #
+        # FIFO status.
+        #
+
+        # Our FIFO is empty if our read and write pointers are at the same position. We'll use the current
+        # read position (which leads ahead) and our read domain's copy of the committed write position.
+        m.d.comb += self.empty.eq(current_read_pointer == write_pointer_in_read_domain)
+
+        # For our space available, we'll use the current write position (which leads ahead) and our committed
+        # read position (which lags behind). Since our pointers wrap around naturally, their difference is
+        # always the amount of space in use.
+        space_used = Signal(pointer_width)
+        m.d.comb += [
+            space_used            .eq(current_write_pointer - read_pointer_in_write_domain),
+            self.space_available  .eq(self.depth - space_used),
+            self.full             .eq(space_used == self.depth),
+        ]
+
+        return m
+
+
 class TransactionalizedFIFOTest(LunaGatewareTestCase):
     FRAGMENT_UNDER_TEST = TransactionalizedFIFO
     FRAGMENT_ARGUMENTS = {'width': 8, 'depth': 16}
@@ -342,5 +581,187 @@ class TransactionalizedFIFOTest(LunaGatewareTestCase):
         self.assertEqual((yield dut.space_available),  16)
 
 
+
+class TransactionalizedFIFOWraparoundTest(LunaGatewareTestCase):
+    FRAGMENT_UNDER_TEST = TransactionalizedFIFO
+
+    # Use a depth that's not a power of two; so our pointers have to explicitly wrap around our memory.
+    FRAGMENT_ARGUMENTS = {'width': 8, 'depth': 12}
+
+    def initialize_signals(self):
+        yield self.dut.write_en.eq(0)
+
+    @sync_test_case
+    def test_fill_to_full(self):
+        dut = self.dut
+
+        # If we fill our FIFO from the very start of our memory, our write pointer wraps around onto our
+        # committed read pointer; which should leave us full, with no space available.
+        yield dut.write_en.eq(1)
+        for i in range(12):
+            yield dut.write_data.eq(i)
+            yield
+        yield dut.write_en.eq(0)
+        yield
+
+        self.assertEqual((yield dut.full),            1)
+        self.assertEqual((yield dut.space_available), 0)
+
+        # Further writes should be ignored, rather than overwriting our data...
+        yield dut.write_data.eq(0xFF)
+        yield from self.pulse(dut.write_en)
+        yield from self.pulse(dut.write_commit)
+
+        # ... so we should read back exactly the data we wrote, and then be empty.
+        yield dut.read_en.eq(1)
+        for i in range(12):
+            yield
+            self.assertEqual((yield dut.read_data), i)
+        yield dut.read_en.eq(0)
+        yield
+
+        self.assertEqual((yield dut.empty), 1)
+
+
+    @sync_test_case
+    def test_wraparound_fill(self):
+        dut = self.dut
+
+        # Move both of our pointers partway through our memory, by writing and then reading eight bytes.
+        yield dut.write_en.eq(1)
+        for i in range(8):
+            yield dut.write_data.eq(i)
+            yield
+        yield dut.write_en.eq(0)
+        yield from self.pulse(dut.write_commit)
+
+        yield dut.read_en.eq(1)
+        for i in range(8):
+            yield
+            self.assertEqual((yield dut.read_data), i)
+        yield dut.read_en.eq(0)
+        yield from self.pulse(dut.read_commit)
+
+        # We should now be empty, with our full depth available.
+        self.assertEqual((yield dut.empty),           1)
+        self.assertEqual((yield dut.full),            0)
+        self.assertEqual((yield dut.space_available), 12)
+
+        # Fill the FIFO completely. This wraps our write pointer past the end of our memory, and around
+        # onto our committed read pointer; so our space available should be correct both before and after
+        # our write pointer wraps.
+        yield dut.write_en.eq(1)
+        for i in range(12):
+            yield dut.write_data.eq(0x10 + i)
+            yield
+            yield dut.write_en.eq(0)
+            yield
+            self.assertEqual((yield dut.space_available), 11 - i)
+            yield dut.write_en.eq(1)
+        yield dut.write_en.eq(0)
+        yield
+
+        # Once we've wrapped all the way around, we should be full.
+        self.assertEqual((yield dut.full),            1)
+        self.assertEqual((yield dut.space_available), 0)
+
+        # Once we commit our data, we should be able to read it all back, in order.
+        yield from self.pulse(dut.write_commit)
+        self.assertEqual((yield dut.empty), 0)
+
+        yield dut.read_en.eq(1)
+        for i in range(4):
+            yield
+            self.assertEqual((yield dut.read_data), 0x10 + i)
+        yield dut.read_en.eq(0)
+
+        # Committing part of our read should free space; with our read pointer now wrapped around, too.
+        yield from self.pulse(dut.read_commit)
+        self.assertEqual((yield dut.full),            0)
+        self.assertEqual((yield dut.space_available), 4)
+
+        yield dut.read_en.eq(1)
+        for i in range(4, 12):
+            yield
+            self.assertEqual((yield dut.read_data), 0x10 + i)
+        yield dut.read_en.eq(0)
+        yield from self.pulse(dut.read_commit)
+
+        # Finally, we should be back to being empty, with all of our space available.
+        self.assertEqual((yield dut.empty),           1)
+        self.assertEqual((yield dut.full),            0)
+        self.assertEqual((yield dut.space_available), 12)
+
+
+class AsyncTransactionalizedFIFOTest(LunaGatewareTestCase):
+    FRAGMENT_UNDER_TEST = AsyncTransactionalizedFIFO
+    FRAGMENT_ARGUMENTS = {'width': 8, 'depth': 16, 'w_domain': 'usb', 'r_domain': 'sync'}
+
+    # Run both of our domains with the same clock period; so our test can drive each of them a cycle at a time.
+    SYNC_CLOCK_FREQUENCY = 60e6
+    USB_CLOCK_FREQUENCY  = 60e6
+
+    def initialize_signals(self):
+        yield self.dut.write_en.eq(0)
+
+    @usb_domain_test_case
+    def test_cross_domain_fill(self):
+        dut = self.dut
+
+        # Our FIFO should start off empty; and with a full depth of free space.
+        self.assertEqual((yield dut.empty),           1)
+        self.assertEqual((yield dut.full),            0)
+        self.assertEqual((yield dut.space_available), 16)
+
+        # If we write four bytes into the FIFO...
+        yield dut.write_en.eq(1)
+        for i in range(4):
+            yield dut.write_data.eq(i)
+            yield
+        yield dut.write_en.eq(0)
+        yield
+
+        # ... we should have less space available, but still be empty; as we've not committed our write.
+        self.assertEqual((yield dut.space_available), 12)
+        yield from self.advance_cycles(10)
+        self.assertEqual((yield dut.empty), 1)
+
+        # Once we _commit_ our write, our data should become visible on our read side after a few cycles.
+        yield from self.pulse(dut.write_commit)
+        self.assertEqual((yield dut.empty), 1)
+        yield from self.advance_cycles(10)
+        self.assertEqual((yield dut.empty), 0)
+
+        # We should be able to read back each of our bytes...
+        for i in range(4):
+            self.assertEqual((yield dut.read_data), i)
+            yield from self.pulse(dut.read_en)
+        self.assertEqual((yield dut.empty), 1)
+
+        # ... but we shouldn't see more space become available until we commit the read.
+        yield from self.advance_cycles(10)
+        self.assertEqual((yield dut.space_available), 12)
+
+        yield from self.pulse(dut.read_commit)
+        yield from self.advance_cycles(10)
+        self.assertEqual((yield dut.space_available), 16)
+
+        # If we write data and then discard it, it should never be seen on the read side.
+        yield dut.write_en.eq(1)
+        for i in range(16):
+            yield dut.write_data.eq(i)
+            yield
+        yield dut.write_en.eq(0)
+        yield
+        self.assertEqual((yield dut.full), 1)
+
+        yield from self.pulse(dut.write_discard)
+        self.assertEqual((yield dut.full), 0)
+        self.assertEqual((yield dut.space_available), 16)
+
+        yield from self.advance_cycles(10)
+        self.assertEqual((yield dut.empty), 1)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -10,12 +10,19 @@ The endpoint interfaces in this module provide endpoint interfaces suitable for
 connecting streams to USB endpoints.
 """
 
-from nmigen         import Elaboratable, Module, Signal
+import unittest
 
-from ..endpoint     import EndpointInterface
-from ...stream      import StreamInterface, USBOutStreamBoundaryDetector
-from ..transfer     import USBInTransferManager
-from ....memory     import TransactionalizedFIFO
+from nmigen            import Elaboratable, Module, Signal, Cat, Repl
+from nmigen.lib.cdc    import FFSynchronizer
+from nmigen.lib.coding import GrayDecoder
+from nmigen.sim        import Passive
+from nmigen.utils      import bits_for
+
+from ..endpoint        import EndpointInterface
+from ...stream         import StreamInterface, USBOutStreamBoundaryDetector
+from ..transfer        import USBInTransferManager
+from ....memory        import TransactionalizedFIFO, AsyncTransactionalizedFIFO
+from ....test          import LunaGatewareTestCase, usb_domain_test_case
 
 
 class USBStreamInEndpoint(Elaboratable):
@@ -27,8 +34,8 @@ class USBStreamInEndpoint(Elaboratable):
     a short data packet. If the stream's ``last`` signal is tied to zero, then a continuous stream of
     maximum-length-packets will be sent with no inserted ZLPs.
 
-    This implementation is double buffered; and can store a single packets worth of data while transmitting
-    a second packet.
+    This implementation is multi-buffered; and can store up to ``num_buffers - 1`` packets worth of data while
+    transmitting another packet.
 
 
     Attributes
@@ -47,13 +54,16 @@ class USBStreamInEndpoint(Elaboratable):
     max_packet_size: int
         The maximum packet size for this endpoint. Should match the wMaxPacketSize provided in the
         USB endpoint descriptor.
+    num_buffers: int, optional
+        The number of packet buffers to use; between two and four. Defaults to two.
     """
 
 
-    def __init__(self, *, endpoint_number, max_packet_size):
+    def __init__(self, *, endpoint_number, max_packet_size, num_buffers=2):
 
         self._endpoint_number = endpoint_number
         self._max_packet_size = max_packet_size
+        self._num_buffers     = num_buffers
 
         #
         # I/O port
@@ -67,7 +77,7 @@ class USBStreamInEndpoint(Elaboratable):
         interface = self.interface
 
         # Create our transfer manager, which will be used to sequence packet transfers for our stream.
-        m.submodules.tx_manager = tx_manager = USBInTransferManager(self._max_packet_size)
+        m.submodules.tx_manager = tx_manager = USBInTransferManager(self._max_packet_size, self._num_buffers)
 
         m.d.comb += [
 
@@ -106,8 +116,8 @@ class USBMultibyteStreamInEndpoint(Elaboratable):
     a short data packet. If the stream's ``last`` signal is tied to zero, then a continuous stream of
     maximum-length-packets will be sent with no inserted ZLPs.
 
-    This implementation is double buffered; and can store a single packets worth of data while transmitting
-    a second packet.
+    This implementation is multi-buffered; and can store up to ``num_buffers - 1`` packets worth of data while
+    transmitting another packet.
 
 
     Attributes
@@ -127,11 +137,14 @@ class USBMultibyteStreamInEndpoint(Elaboratable):
     max_packet_size: int
         The maximum packet size for this endpoint. Should match the wMaxPacketSize provided in the
         USB endpoint descriptor.
+    num_buffers: int, optional
+        The number of packet buffers to use; between two and four. Defaults to two.
     """
-    def __init__(self, *, byte_width, endpoint_number, max_packet_size):
+    def __init__(self, *, byte_width, endpoint_number, max_packet_size, num_buffers=2):
         self._byte_width      = byte_width
         self._endpoint_number = endpoint_number
         self._max_packet_size = max_packet_size
+        self._num_buffers     = num_buffers
 
         #
         # I/O port
@@ -146,7 +159,8 @@ class USBMultibyteStreamInEndpoint(Elaboratable):
         # Create our core, single-byte-wide endpoint, and attach it directly to our interface.
         m.submodules.stream_ep = stream_ep = USBStreamInEndpoint(
             endpoint_number=self._endpoint_number,
-            max_packet_size=self._max_packet_size
+            max_packet_size=self._max_packet_size,
+            num_buffers=self._num_buffers
         )
         stream_ep.interface = self.interface
 
@@ -155,19 +169,26 @@ class USBMultibyteStreamInEndpoint(Elaboratable):
         byte_stream = stream_ep.stream
         word_stream = self.stream
 
-        # We'll put each word to be sent through an shift register
-        # that shifts out words a byte at a time.
-        data_shift = Signal.like(word_stream.payload)
+        # We'll latch each word to be sent, and then select each of its bytes in turn
+        # using a one-hot byte mask; rather than shifting the whole word each time a byte is sent.
+        # Keeping the mask one-hot means our first/last checks are single-bit picks.
+        data_latched = Signal.like(word_stream.payload)
+        byte_mask    = Signal(self._byte_width, reset=1)
 
         # Latched versions of our first and last signals.
         first_latched = Signal()
         last_latched  = Signal()
 
-        # Count how many bytes we have left to send.
-        bytes_to_send = Signal(range(0, self._byte_width + 1))
+        # Always provide our inner transmitter with the currently selected byte of our latched word.
+        # As our mask is one-hot, we can select our byte by masking off every other byte, and then
+        # OR'ing the results together; this keeps our selection a single, flat level of logic.
+        selected_bytes = [data_latched.word_select(i, 8) & Repl(byte_mask[i], 8) for i in range(self._byte_width)]
+
+        selected_byte = selected_bytes[0]
+        for byte in selected_bytes[1:]:
+            selected_byte = selected_byte | byte
 
-        # Always provide our inner transmitter with the least byte of our shift register.
-        m.d.comb += byte_stream.payload.eq(data_shift[0:8])
+        m.d.comb += byte_stream.payload.eq(selected_byte)
 
 
         with m.FSM(domain="usb"):
@@ -176,14 +197,14 @@ class USBMultibyteStreamInEndpoint(Elaboratable):
             with m.State("IDLE"):
                 m.d.comb += word_stream.ready.eq(1)
 
-                # Once we get a send request, fill in our shift register, and start shifting.
+                # Once we get a send request, latch our word, and start sending.
                 with m.If(word_stream.valid):
                     m.d.usb += [
-                        data_shift         .eq(word_stream.payload),
+                        data_latched       .eq(word_stream.payload),
                         first_latched      .eq(word_stream.first),
                         last_latched       .eq(word_stream.last),
 
-                        bytes_to_send      .eq(self._byte_width - 1),
+                        byte_mask          .eq(1),
                     ]
                     m.next = "TRANSMIT"
 
@@ -194,8 +215,8 @@ class USBMultibyteStreamInEndpoint(Elaboratable):
 
                 # Once the byte-stream is accepting our input...
                 with m.If(byte_stream.ready):
-                    is_first_byte = (bytes_to_send == self._byte_width - 1)
-                    is_last_byte  = (bytes_to_send == 0)
+                    is_first_byte = byte_mask[0]
+                    is_last_byte  = byte_mask[-1]
 
                     # Pass through our First and Last signals, but only on the first and
                     # last bytes of our word, respectively.
@@ -205,11 +226,8 @@ class USBMultibyteStreamInEndpoint(Elaboratable):
                     ]
 
                     # ... if we have bytes left to send, move to the next one.
-                    with m.If(bytes_to_send > 0):
-                        m.d.usb += [
-                            bytes_to_send .eq(bytes_to_send - 1),
-                            data_shift    .eq(data_shift[8:]),
-                        ]
+                    with m.If(~is_last_byte):
+                        m.d.usb += byte_mask.eq(byte_mask.rotate_left(1))
 
                     # Otherwise, complete the frame.
                     with m.Else():
@@ -218,11 +236,11 @@ class USBMultibyteStreamInEndpoint(Elaboratable):
                         # If we still have data to send, move to the next byte...
                         with m.If(self.stream.valid):
                             m.d.usb += [
-                                data_shift     .eq(word_stream.payload),
+                                data_latched   .eq(word_stream.payload),
                                 first_latched  .eq(word_stream.first),
                                 last_latched   .eq(word_stream.last),
 
-                                bytes_to_send  .eq(self._byte_width - 1),
+                                byte_mask      .eq(1),
                             ]
 
                         # ... otherwise, move to our idle state.
@@ -259,14 +277,24 @@ class USBStreamOutEndpoint(Elaboratable):
         the endpoint buffer, this endpoint will NAK (or participate in the PING protocol.)
     buffer_size: int, optional
         The total amount of data we'll keep in the buffer; typically two max-packet-sizes or more.
-        Defaults to twice the maximum packet size.
+        The buffer is managed as ``buffer_size // max_packet_size`` packet slots; so with the default
+        of twice the maximum packet size, we can receive one packet while the previous is still being
+        read out of our stream.
+    stream_domain: str, optional
+        The clock domain our output :attr:``stream`` should exist in. If this isn't the ``usb`` domain,
+        our buffer will be a dual-clock FIFO; and ``buffer_size`` must be a power of two. Defaults to ``usb``.
     """
 
 
-    def __init__(self, *, endpoint_number, max_packet_size, buffer_size=None):
+    def __init__(self, *, endpoint_number, max_packet_size, buffer_size=None, stream_domain="usb"):
         self._endpoint_number = endpoint_number
         self._max_packet_size = max_packet_size
         self._buffer_size = buffer_size if (buffer_size is not None) else (self._max_packet_size * 2)
+        self._stream_domain = stream_domain
+
+        # If our buffer crosses clock domains, its pointers are Gray-coded; so it must be a power of two.
+        if (stream_domain != "usb") and (self._buffer_size & (self._buffer_size - 1)):
+            raise ValueError(f"buffer_size must be a power of two when crossing domains, not {self._buffer_size}")
 
         #
         # I/O port
@@ -286,9 +314,6 @@ class USBStreamOutEndpoint(Elaboratable):
         # Internal state.
         #
 
-        # Stores whether this is the first byte of a transfer. True if the previous byte had its `last` bit set.
-        is_first_byte = Signal(reset=1)
-
         # Stores the data toggle value we expect.
         expected_data_toggle = Signal()
 
@@ -306,62 +331,176 @@ class USBStreamOutEndpoint(Elaboratable):
         ]
 
         rx       = boundary_detector.processed_stream
-        rx_first = boundary_detector.first
         rx_last  = boundary_detector.last
 
-        # Create a Rx FIFO.
-        m.submodules.fifo = fifo = TransactionalizedFIFO(width=10, depth=self._buffer_size, name="rx_fifo", domain="usb")
-
-        # Generate our `first` bit from the most recently transmitted bit.
-        # Essentially, if the most recently valid byte was accompanied by an asserted `last`, the next byte
-        # should have `first` asserted.
+        # Create a Rx FIFO. If our stream lives in another domain, this FIFO will also carry our data across
+        # into that domain.
+        if self._stream_domain == "usb":
+            fifo = TransactionalizedFIFO(width=9, depth=self._buffer_size, name="rx_fifo", domain="usb")
+        else:
+            fifo = AsyncTransactionalizedFIFO(width=9, depth=self._buffer_size, name="rx_fifo",
+                w_domain="usb", r_domain=self._stream_domain)
+        m.submodules.fifo = fifo
+
+        # We don't store our `first` bit in our FIFO; instead, we'll generate it from the most recently
+        # transmitted byte. Essentially, if the most recently valid byte was accompanied by an asserted `last`,
+        # the next byte should have `first` asserted.
+        last_byte_sent = Signal(reset=1)
         with m.If(stream.valid & stream.ready):
-            m.d.usb += is_first_byte.eq(stream.last)
+            m.d[self._stream_domain] += last_byte_sent.eq(stream.last)
 
 
         #
         # Create some basic conditionals that will help us make decisions.
         #
 
-        endpoint_number_matches  = (tokenizer.endpoint == self._endpoint_number)
-        targeting_endpoint       = endpoint_number_matches & tokenizer.is_out
+        # We'll register the conditions that feed our handshake decisions; so the comparisons that generate
+        # them don't sit on the same combinational path as our handshake outputs. Each of these inputs is
+        # stable for several cycles before we'd use it to respond.
+        endpoint_number_matches  = Signal()
+        expected_pid_match       = Signal()
+        sufficient_space         = Signal()
+        ready_for_response       = Signal()
+        rx_ready_for_response    = Signal()
+
+        m.d.usb += [
+            expected_pid_match       .eq(interface.rx_pid_toggle == expected_data_toggle),
+            ready_for_response       .eq(tokenizer.ready_for_response),
+            rx_ready_for_response    .eq(interface.rx_ready_for_response),
+        ]
 
-        expected_pid_match       = (interface.rx_pid_toggle == expected_data_toggle)
-        sufficient_space         = (fifo.space_available >= self._max_packet_size)
+        # Our token's endpoint number only changes when a new token arrives; so we only need to
+        # check it once per token.
+        with m.If(tokenizer.new_token):
+            m.d.usb += endpoint_number_matches.eq(tokenizer.endpoint == self._endpoint_number)
+
+        # Rather than comparing our FIFO's space available against our max packet size, we'll keep
+        # a count of how many max-sized packets we still have room for. A packet's slot is taken when
+        # it's committed into our FIFO, and returned once its last byte is read back out.
+        packets_in_buffer = self._buffer_size // self._max_packet_size
+        packets_free      = Signal(range(packets_in_buffer + 1), reset=packets_in_buffer)
+        packet_written    = Signal()
+
+        packet_committed  = fifo.write_commit & packet_written
+        packet_freed      = stream.valid & stream.ready & stream.last
+
+        # If our stream is in our domain, we can count freed packets directly.
+        if self._stream_domain == "usb":
+            packets_freed = packet_freed
+
+        # Otherwise, we'll count packets as they're read, and pass that count back into our domain Gray-coded.
+        # Our count needs to be able to represent a full buffer's worth of packets freed at once.
+        else:
+            count_width       = bits_for(packets_in_buffer) + 1
+            packets_read      = Signal(count_width)
+            packets_read_gray = Signal(count_width)
+            synchronized_gray = Signal(count_width)
+
+            next_count        = Signal(count_width)
+
+            m.d.comb += next_count.eq(packets_read + 1)
+            with m.If(packet_freed):
+                m.d[self._stream_domain] += [
+                    packets_read       .eq(next_count),
+                    packets_read_gray  .eq(next_count ^ next_count[1:]),
+                ]
+            m.submodules += FFSynchronizer(packets_read_gray, synchronized_gray, o_domain="usb")
+
+            m.submodules.packets_read_decoder = decoder = GrayDecoder(count_width)
+            m.d.comb += decoder.i.eq(synchronized_gray)
+
+            # Each cycle, we'll free however many packets have been read since we last looked.
+            packets_read_seen = Signal(count_width)
+            packets_freed     = Signal(count_width)
+            m.d.comb += packets_freed.eq(decoder.o - packets_read_seen)
+            m.d.usb  += packets_read_seen.eq(decoder.o)
+
+        m.d.usb += packets_free.eq(packets_free + packets_freed - packet_committed)
+
+        # Keep track of whether we've written any data since our last commit or discard; so zero-length
+        # packets don't take up a slot.
+        with m.If(fifo.write_commit | fifo.write_discard):
+            m.d.usb += packet_written.eq(0)
+        with m.Elif(fifo.write_en):
+            m.d.usb += packet_written.eq(1)
+
+        # We'll decide whether we have space for a packet when its token arrives; so our decision
+        # can't change partway through receiving a packet.
+        with m.If(tokenizer.new_token):
+            m.d.usb += sufficient_space.eq(packets_free != 0)
 
-        ping_response_requested  = endpoint_number_matches & tokenizer.is_ping & tokenizer.ready_for_response
-        data_response_requested  = targeting_endpoint & tokenizer.is_out & interface.rx_ready_for_response
+        targeting_endpoint       = endpoint_number_matches & tokenizer.is_out
+
+        ping_response_requested  = endpoint_number_matches & tokenizer.is_ping & ready_for_response
+        data_response_requested  = targeting_endpoint & tokenizer.is_out & rx_ready_for_response
 
         okay_to_receive          = targeting_endpoint & sufficient_space & expected_pid_match
         should_skip              = targeting_endpoint & ~expected_pid_match
 
-        m.d.comb += [
+        # We'll pass each received byte through a register stage before it reaches our FIFO; so our decision
+        # to receive isn't on the same combinational path as our FIFO's write enable. Our receive stream can't
+        # be stalled, so this is a plain pipeline register, with no backpressure. Our commit and discard strobes
+        # are delayed alongside our data; so they still arrive after the last byte of our packet is written.
+        rx_registered_valid    = Signal()
+        rx_registered_payload  = Signal(9)
+        rx_registered_commit   = Signal()
+        rx_registered_discard  = Signal()
+
+        # We'll also register our packet-boundary strobes before they're used; so they reach our FIFO
+        # from flops, rather than from the receiver's CRC logic. They're delayed an extra cycle relative
+        # to our data; which only means our commit/discard arrives one cycle later.
+        rx_complete      = Signal()
+        rx_invalid       = Signal()
+
+        m.d.usb += [
+            rx_complete      .eq(boundary_detector.complete_out),
+            rx_invalid       .eq(boundary_detector.invalid_out),
+        ]
+
+        m.d.usb += [
 
             # We'll always populate our FIFO directly from the receive stream; but we'll also include our
             # "short packet detected" signal, as this indicates that we're detecting the last byte of a transfer.
-            fifo.write_data[0:8] .eq(rx.payload),
-            fifo.write_data[8]   .eq(rx_last),
-            fifo.write_data[9]   .eq(rx_first),
-            fifo.write_en        .eq(okay_to_receive & rx.next & rx.valid),
+            rx_registered_payload  .eq(Cat(rx.payload, rx_last)),
+            rx_registered_valid    .eq(okay_to_receive & rx.next & rx.valid),
 
             # We'll keep data if our packet finishes with a valid CRC; and discard it otherwise.
-            fifo.write_commit    .eq(targeting_endpoint & boundary_detector.complete_out),
-            fifo.write_discard   .eq(targeting_endpoint & boundary_detector.invalid_out),
+            rx_registered_commit   .eq(targeting_endpoint & rx_complete),
+            rx_registered_discard  .eq(targeting_endpoint & rx_invalid),
+        ]
+
+        # We'll register our handshake decisions; so our handshake outputs are driven directly from flops,
+        # rather than from the full decision logic. Our response is only permitted some time after the
+        # end of the packet, so we have ample time for the extra cycle.
+        issue_ack = Signal()
+        issue_nak = Signal()
+
+        m.d.usb += [
 
             # We'll ACK each packet if it's received correctly; _or_ if we skipped the packet
             # due to a PID sequence mismatch. If we get a PID sequence mismatch, we assume that
             # we missed a previous ACK from the host; and ACK without accepting data [USB 2.0: 8.6.3].
-            interface.handshakes_out.ack  .eq(
+            issue_ack  .eq(
                 (data_response_requested & okay_to_receive) |
                 (ping_response_requested & okay_to_receive) |
                 (data_response_requested & should_skip)
             ),
 
             # We'll NAK any time we want to accept a packet, but we don't have enough room.
-            interface.handshakes_out.nak  .eq(
+            issue_nak  .eq(
                 (data_response_requested & ~okay_to_receive & ~should_skip) |
                 (ping_response_requested & ~okay_to_receive)
             ),
+        ]
+
+        m.d.comb += [
+            fifo.write_data      .eq(rx_registered_payload),
+            fifo.write_en        .eq(rx_registered_valid),
+            fifo.write_commit    .eq(rx_registered_commit),
+            fifo.write_discard   .eq(rx_registered_discard),
+
+            interface.handshakes_out.ack  .eq(issue_ack),
+            interface.handshakes_out.nak  .eq(issue_nak),
 
             # Our stream data always comes directly out of the FIFO; and is valid
             # henever our FIFO actually has data for us to read.
@@ -371,7 +510,7 @@ class USBStreamOutEndpoint(Elaboratable):
             # Our `last` bit comes directly from the FIFO; and we know a `first` bit immediately
             # follows a `last` one.
             stream.last       .eq(fifo.read_data[8]),
-            stream.first      .eq(fifo.read_data[9]),
+            stream.first      .eq(last_byte_sent),
 
             # Move to the next byte in the FIFO whenever our stream is advaced.
             fifo.read_en      .eq(stream.ready),
@@ -379,9 +518,309 @@ class USBStreamOutEndpoint(Elaboratable):
         ]
 
         # We'll toggle our DATA PID each time we issue an ACK to the host [USB 2.0: 8.6.2].
-        with m.If(data_response_requested & okay_to_receive):
+        # We register our ACK decision first; the next packet can't arrive for many cycles, so this
+        # delay is harmless, and it keeps our decision logic off our toggle's input path.
+        data_acked = Signal()
+        m.d.usb += data_acked.eq(data_response_requested & okay_to_receive)
+
+        with m.If(data_acked):
             m.d.usb += expected_data_toggle.eq(~expected_data_toggle)
 
 
         return m
 
+
+
+class ObservableMultibyteStreamInEndpoint(USBMultibyteStreamInEndpoint):
+    """ Test variant of our multibyte endpoint that exposes the byte stream it feeds its inner endpoint. """
+
+    def elaborate(self, platform):
+        m = super().elaborate(platform)
+        self.byte_stream = m.submodules.stream_ep.stream
+        return m
+
+
+class USBMultibyteStreamInEndpointTest(LunaGatewareTestCase):
+    FRAGMENT_UNDER_TEST = ObservableMultibyteStreamInEndpoint
+    FRAGMENT_ARGUMENTS  = {"byte_width": 4, "endpoint_number": 1, "max_packet_size": 64, "num_buffers": 4}
+
+    SYNC_CLOCK_FREQUENCY = None
+    USB_CLOCK_FREQUENCY  = 60e6
+
+
+    def transfer_words(self, transfers):
+        """ Sends each of a collection of transfers, with idle time between them; returns the bytes produced.
+
+        Each transfer is a list of words, which are sent back to back. Returns a list of
+        (payload, first, last) tuples for each byte accepted by our inner endpoint.
+        """
+
+        word_stream = self.dut.stream
+        byte_stream = self.dut.byte_stream
+        bytes_seen  = []
+
+        # Build a schedule of the words to send, with a run of idle cycles after each transfer.
+        schedule = []
+        for transfer in transfers:
+            schedule.extend(transfer)
+            schedule.extend([None] * 4)
+
+        position = 0
+        for _ in range(len(schedule) * 8):
+            if position == len(schedule):
+                break
+
+            entry = schedule[position]
+
+            # Present our current word, if we have one...
+            if entry is None:
+                yield word_stream.valid.eq(0)
+            else:
+                payload, first, last = entry
+                yield word_stream.payload .eq(payload)
+                yield word_stream.first   .eq(first)
+                yield word_stream.last    .eq(last)
+                yield word_stream.valid   .eq(1)
+            yield
+
+            # ... and move on once it's been accepted; or once an idle cycle has passed.
+            if (entry is None) or (yield word_stream.ready):
+                position += 1
+
+            # Capture each byte handed to our inner endpoint.
+            if (yield byte_stream.valid) and (yield byte_stream.ready):
+                bytes_seen.append(((yield byte_stream.payload), (yield byte_stream.first), (yield byte_stream.last)))
+
+        self.assertEqual(position, len(schedule), "timed out while sending words")
+        return bytes_seen
+
+
+    @usb_domain_test_case
+    def test_word_to_byte_conversion(self):
+        byte_width = self.FRAGMENT_ARGUMENTS["byte_width"]
+
+        # Create words whose bytes count upwards; so we can easily check our byte order.
+        def words(start, count):
+            return [int.from_bytes(bytes(range(start + i * byte_width, start + (i + 1) * byte_width)), "little")
+                for i in range(count)]
+
+        def transfer(start, count):
+            return [(word, i == 0, i == count - 1) for i, word in enumerate(words(start, count))]
+
+        # Send a transfer of back-to-back words; then two more, each after our endpoint has gone idle.
+        transfers = [
+            transfer(0, 3),
+            transfer(3 * byte_width, 1),
+            transfer(4 * byte_width, 2),
+        ]
+        bytes_seen = yield from self.transfer_words(transfers)
+
+        # We should see every byte of every word, in little-endian order; with `first` set only on the first
+        # byte of each transfer's first word, and `last` only on the last byte of each transfer's last word.
+        expected = []
+        for transfer_words in transfers:
+            for word_index, (word, first, last) in enumerate(transfer_words):
+                for byte_index in range(byte_width):
+                    expected.append((
+                        (word >> (byte_index * 8)) & 0xFF,
+                        int(first and (byte_index == 0)),
+                        int(last  and (byte_index == byte_width - 1)),
+                    ))
+
+        self.assertEqual(bytes_seen, expected)
+
+
+class USBSingleByteMultibyteStreamInEndpointTest(USBMultibyteStreamInEndpointTest):
+    FRAGMENT_ARGUMENTS  = {"byte_width": 1, "endpoint_number": 1, "max_packet_size": 64, "num_buffers": 4}
+
+
+
+class USBStreamOutEndpointTest(LunaGatewareTestCase):
+    FRAGMENT_UNDER_TEST = USBStreamOutEndpoint
+    FRAGMENT_ARGUMENTS  = {"endpoint_number": 1, "max_packet_size": 8}
+
+    SYNC_CLOCK_FREQUENCY = None
+    USB_CLOCK_FREQUENCY  = 60e6
+
+
+    def send_token(self, *, endpoint=1):
+        """ Simulates the host sending an OUT token to the given endpoint. """
+        tokenizer = self.dut.interface.tokenizer
+
+        yield tokenizer.endpoint .eq(endpoint)
+        yield tokenizer.is_out   .eq(1)
+        yield from self.pulse(tokenizer.new_token)
+
+
+    def send_packet(self, data, *, pid_toggle, valid=True):
+        """ Simulates the host sending a DATA packet following an OUT token. """
+        interface = self.dut.interface
+
+        yield interface.rx_pid_toggle.eq(pid_toggle)
+        yield interface.rx.valid.eq(1)
+
+        for byte in data:
+            yield interface.rx.payload.eq(byte)
+            yield interface.rx.next.eq(1)
+            yield
+        yield interface.rx.next.eq(0)
+        yield from self.advance_cycles(2)
+        yield interface.rx.valid.eq(0)
+
+        # Finally, mark our packet as having either a valid or invalid CRC.
+        yield from self.pulse(interface.rx_complete if valid else interface.rx_invalid)
+
+
+    def get_handshake(self):
+        """ Allows our endpoint to respond to the last packet; returns "ack", "nak", or None. """
+        handshakes = self.dut.interface.handshakes_out
+
+        yield from self.pulse(self.dut.interface.rx_ready_for_response, step_after=False)
+        for _ in range(5):
+            if (yield handshakes.ack):
+                return "ack"
+            if (yield handshakes.nak):
+                return "nak"
+            yield
+
+        return None
+
+
+    def send_out_transaction(self, data, *, pid_toggle, valid=True):
+        """ Simulates a complete OUT transaction; returning the handshake our endpoint issues.
+
+        Packets with an invalid CRC are never responded to; so they always return None.
+        """
+        yield from self.send_token()
+        yield from self.advance_cycles(2)
+        yield from self.send_packet(data, pid_toggle=pid_toggle, valid=valid)
+        yield from self.advance_cycles(2)
+
+        handshake = (yield from self.get_handshake()) if valid else None
+        yield from self.advance_cycles(5)
+        return handshake
+
+
+    def read_packet(self):
+        """ Reads a single packet from our endpoint's stream; returning its data. """
+        stream = self.dut.stream
+        data   = []
+
+        yield stream.ready.eq(1)
+        while True:
+            yield
+            if (yield stream.valid):
+                data.append((yield stream.payload))
+                self.assertEqual((yield stream.first), len(data) == 1)
+
+                if (yield stream.last):
+                    break
+        yield stream.ready.eq(0)
+        yield
+
+        return data
+
+
+    @usb_domain_test_case
+    def test_packet_slots(self):
+        first_packet  = [0x10, 0x11, 0x12, 0x13, 0x14, 0x15, 0x16, 0x17]
+        second_packet = [0x20, 0x21, 0x22, 0x23, 0x24, 0x25, 0x26, 0x27]
+        third_packet  = [0x30, 0x31, 0x32, 0x33]
+        fourth_packet = [0x40, 0x41, 0x42, 0x43, 0x44, 0x45, 0x46, 0x47]
+
+        # With our stream stalled, we should accept packets until each of our two packet slots is full...
+        self.assertEqual((yield from self.send_out_transaction(first_packet,  pid_toggle=0)), "ack")
+        self.assertEqual((yield from self.send_out_transaction(second_packet, pid_toggle=1)), "ack")
+
+        # ... and then NAK any further packets.
+        self.assertEqual((yield from self.send_out_transaction(third_packet, pid_toggle=0)), "nak")
+
+        # Once a packet is read out of our stream, its slot should be freed.
+        self.assertEqual((yield from self.read_packet()), first_packet)
+
+        # A zero-length packet should be accepted without taking a slot...
+        self.assertEqual((yield from self.send_out_transaction([], pid_toggle=0)), "ack")
+
+        # ... so we should still have room for our next packet.
+        self.assertEqual((yield from self.send_out_transaction(third_packet, pid_toggle=1)), "ack")
+
+        # Once we've freed another slot, a packet that fails its CRC should be discarded; and shouldn't
+        # take our slot, either.
+        self.assertEqual((yield from self.read_packet()), second_packet)
+        self.assertEqual((yield from self.send_out_transaction(fourth_packet, pid_toggle=0, valid=False)), None)
+        self.assertEqual((yield from self.send_out_transaction(fourth_packet, pid_toggle=0)), "ack")
+
+        # We should now be full again...
+        self.assertEqual((yield from self.send_out_transaction(first_packet, pid_toggle=1)), "nak")
+
+        # ... and we should read exactly the packets we accepted, without any of the discarded data.
+        self.assertEqual((yield from self.read_packet()), third_packet)
+        self.assertEqual((yield from self.read_packet()), fourth_packet)
+
+        yield from self.advance_cycles(2)
+        self.assertEqual((yield self.dut.stream.valid), 0)
+
+
+class USBStreamOutEndpointCrossDomainTest(USBStreamOutEndpointTest):
+    """ Runs our OUT endpoint tests with our stream in a faster, independent clock domain. """
+
+    FRAGMENT_ARGUMENTS  = {"endpoint_number": 1, "max_packet_size": 8, "stream_domain": "sync"}
+
+    SYNC_CLOCK_FREQUENCY = 100e6
+    USB_CLOCK_FREQUENCY  = 60e6
+
+    def setUp(self):
+        super().setUp()
+
+        # Our stream lives in the sync domain; so we'll consume it from a sync-domain process,
+        # which reads packets from the stream whenever our test asks for one.
+        self.packets_requested = 0
+        self.packets_received  = []
+        self.sim.add_sync_process(self.consume_stream, domain="sync")
+
+
+    def consume_stream(self):
+        stream = self.dut.stream
+        data   = []
+
+        yield Passive()
+        while True:
+            yield stream.ready.eq(len(self.packets_received) < self.packets_requested)
+            yield
+
+            if (yield stream.valid) and (yield stream.ready):
+                data.append((yield stream.payload))
+                self.assertEqual((yield stream.first), len(data) == 1)
+
+                if (yield stream.last):
+                    self.packets_received.append(data)
+                    data = []
+
+
+    def read_packet(self):
+        self.packets_requested += 1
+        while len(self.packets_received) < self.packets_requested:
+            yield
+
+        # Give our freed packet slot time to make its way back into the USB domain.
+        yield from self.advance_cycles(10)
+        return self.packets_received[-1]
+
+
+
+
+class USBStreamOutEndpointSlowStreamTest(USBStreamOutEndpointCrossDomainTest):
+    """ Runs our OUT endpoint tests with our stream in a slower, independent clock domain. """
+
+    SYNC_CLOCK_FREQUENCY = 24e6
+
+
+class USBStreamOutEndpointParameterTest(unittest.TestCase):
+
+    def test_cross_domain_buffer_must_be_power_of_two(self):
+        with self.assertRaises(ValueError):
+            USBStreamOutEndpoint(endpoint_number=1, max_packet_size=8, buffer_size=24, stream_domain="sync")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -69,11 +69,18 @@ class USBInTransferManager(Elaboratable):
     ----------
     max_packet_size: int
         The maximum packet size for our associated endpoint, in bytes.
+    num_buffers: int, optional
+        The number of packet buffers to use; between two and four. Additional buffers allow our producer
+        to queue up several packets while a previous one is being transmitted. Defaults to two.
     """
 
-    def __init__(self, max_packet_size):
+    def __init__(self, max_packet_size, num_buffers=2):
+
+        if not (2 <= num_buffers <= 4):
+            raise ValueError("num_buffers must be between two and four")
 
         self._max_packet_size = max_packet_size
+        self._num_buffers     = num_buffers
 
         #
         # I/O port
@@ -98,6 +105,7 @@ class USBInTransferManager(Elaboratable):
 
     def elaborate(self, platform):
         m = Module()
+        num_buffers = self._num_buffers
 
         #
         # Transciever state.
@@ -121,24 +129,26 @@ class USBInTransferManager(Elaboratable):
         # Accordingly, we'll buffer a full USB packet of data, and then transmit
         # it once either a) our buffer is full, or 2) the transfer ends (last=1).
         #
-        # This implementation is double buffered; so a buffer fill can be pipelined
-        # with a transmit.
+        # This implementation is multi-buffered; so one or more buffer fills can be
+        # pipelined with a transmit.
         #
 
-        # We'll create two buffers; so we can fill one as we empty the other.
-        # Since each buffer will be used for every other transaction, and our PID toggle flips every other transcation,
-        # we'll identify which buffer we're targeting by the current PID toggle.
-        buffer = Array(Memory(width=8, depth=self._max_packet_size, name=f"transmit_buffer_{i}") for i in range(2))
-        buffer_write_ports = Array(buffer[i].write_port(domain="usb") for i in range(2))
-        buffer_read_ports  = Array(buffer[i].read_port(domain="usb") for i in range(2))
+        # We'll create a ring of buffers; so we can fill some as we empty another.
+        buffer = Array(Memory(width=8, depth=self._max_packet_size, name=f"transmit_buffer_{i}") for i in range(num_buffers))
+        buffer_write_ports = Array(buffer[i].write_port(domain="usb") for i in range(num_buffers))
+        buffer_read_ports  = Array(buffer[i].read_port(domain="usb") for i in range(num_buffers))
+
+        for i in range(num_buffers):
+            m.submodules[f"read_port_{i}"]  = buffer_read_ports[i]
+            m.submodules[f"write_port_{i}"] = buffer_write_ports[i]
 
-        m.submodules.read_port_0,  m.submodules.read_port_1  = buffer_read_ports
-        m.submodules.write_port_0, m.submodules.write_port_1 = buffer_write_ports
+        # Keep track of the buffer currently being filled, and the buffer currently being sent.
+        # Each advances around our ring of buffers whenever its buffer is finished with.
+        write_buffer_number = Signal(range(num_buffers))
+        read_buffer_number  = Signal(range(num_buffers))
 
-        # Create values equivalent to the buffer numbers for our read and write buffer; which switch
-        # whenever we swap our two buffers.
-        write_buffer_number =  self.data_pid[0]
-        read_buffer_number  = ~self.data_pid[0]
+        # Keep track of how many buffers hold complete packets; including the packet currently being sent.
+        buffers_filled = Signal(range(num_buffers + 1))
 
         # Create a shorthand that refers to the buffer to be filled; and the buffer to send from.
         # We'll call these the Read and Write buffers.
@@ -151,8 +161,8 @@ class USBInTransferManager(Elaboratable):
         #   the given buffer. This indicates that the buffer cannot be filled further; and, when
         #   ``generate_zlps`` is enabled, is used to determine if the given buffer should end in
         #   a short packet; which determines whether ZLPs are emitted.
-        buffer_fill_count   = Array(Signal(range(0, self._max_packet_size + 1)) for _ in range(2))
-        buffer_stream_ended = Array(Signal(name=f"stream_ended_in_buffer{i}") for i in range(2))
+        buffer_fill_count   = Array(Signal(range(0, self._max_packet_size + 1)) for _ in range(num_buffers))
+        buffer_stream_ended = Array(Signal(name=f"stream_ended_in_buffer{i}") for i in range(num_buffers))
 
         # Create shortcuts to active fill_count / stream_ended signals for the buffer being written.
         write_fill_count   = buffer_fill_count[write_buffer_number]
@@ -173,20 +183,22 @@ class USBInTransferManager(Elaboratable):
         # Use our memory's two ports to capture data from our transfer stream; and two emit packets
         # into our packet stream. Since we'll never receive to anywhere else, or transmit to anywhere else,
         # we can just unconditionally connect these.
-        m.d.comb += [
+        #
+        # We'll only ever -write- data from our input stream...
+        for write_port in buffer_write_ports:
+            m.d.comb += [
+                write_port.data  .eq(in_stream.payload),
+                write_port.addr  .eq(write_fill_count),
+            ]
 
-            # We'll only ever -write- data from our input stream...
-            buffer_write_ports[0].data   .eq(in_stream.payload),
-            buffer_write_ports[0].addr   .eq(write_fill_count),
-            buffer_write_ports[1].data   .eq(in_stream.payload),
-            buffer_write_ports[1].addr   .eq(write_fill_count),
+        m.d.comb += [
 
             # ... and we'll only ever -send- data from the Read buffer.
             buffer_read.addr             .eq(send_position),
             out_stream.payload           .eq(buffer_read.data),
 
-            # We're ready to receive data iff we have space in the buffer we're currently filling.
-            in_stream.ready              .eq((write_fill_count != self._max_packet_size) & ~write_stream_ended),
+            # We're ready to receive data iff we have a buffer that's not waiting to be sent.
+            in_stream.ready              .eq(buffers_filled != num_buffers),
             buffer_write.en              .eq(in_stream.valid & in_stream.ready)
         ]
 
@@ -199,6 +211,37 @@ class USBInTransferManager(Elaboratable):
             m.d.usb += write_stream_ended.eq(1)
 
 
+        # Our write buffer is complete once it's been filled, or once the stream ends; at which point
+        # it's ready to be sent, and we'll move on to filling the next buffer in our ring.
+        packet_complete  = (write_fill_count + 1 == self._max_packet_size)
+        packet_enqueuing = buffer_write.en & (packet_complete | in_stream.last)
+
+        with m.If(packet_enqueuing):
+            with m.If(write_buffer_number == num_buffers - 1):
+                m.d.usb += write_buffer_number.eq(0)
+            with m.Else():
+                m.d.usb += write_buffer_number.eq(write_buffer_number + 1)
+
+        # Our read buffer is released once the host has received it; at which point it can be refilled.
+        packet_releasing = Signal()
+        with m.If(packet_releasing):
+            m.d.usb += [
+                # Clear the data we've sent from our buffer, and mark it as no longer having ended.
+                read_fill_count    .eq(0),
+                read_stream_ended  .eq(0),
+            ]
+            with m.If(read_buffer_number == num_buffers - 1):
+                m.d.usb += read_buffer_number.eq(0)
+            with m.Else():
+                m.d.usb += read_buffer_number.eq(read_buffer_number + 1)
+
+        # Keep our count of filled buffers up to date.
+        with m.If(packet_enqueuing & ~packet_releasing):
+            m.d.usb += buffers_filled.eq(buffers_filled + 1)
+        with m.Elif(packet_releasing & ~packet_enqueuing):
+            m.d.usb += buffers_filled.eq(buffers_filled - 1)
+
+
         # Shortcut for when we need to deal with an in token.
         # Pulses high an interpacket delay after receiving an IN token.
         in_token_received = self.active & self.tokenizer.is_in & self.tokenizer.ready_for_response
@@ -213,25 +256,14 @@ class USBInTransferManager(Elaboratable):
                 # We can't yet send data; so NAK any packet requests.
                 m.d.comb += self.handshakes_out.nak.eq(in_token_received)
 
-                # If we have valid data that will end our packet, we're no longer waiting for data.
+                # If we have data that will end a packet, we're no longer waiting for data.
                 # We'll now wait for the host to request data from us.
-                packet_complete = (write_fill_count + 1 == self._max_packet_size)
-                will_end_packet = packet_complete | in_stream.last
-
-                with m.If(in_stream.valid & will_end_packet):
-
-                    # If we've just finished a packet, we now have data we can send!
-                    with m.If(packet_complete | in_stream.last):
-                        m.next = "WAIT_TO_SEND"
-                        m.d.usb += [
+                with m.If(packet_enqueuing | (buffers_filled != 0)):
+                    m.next = "WAIT_TO_SEND"
 
-                            # We're now ready to take the data we've captured and _transmit_ it.
-                            # We'll swap our read and write buffers, and toggle our data PID.
-                            self.data_pid[0]    .eq(~self.data_pid[0]),
-
-                            # Mark our current stream as no longer having ended.
-                            read_stream_ended  .eq(0)
-                        ]
+                    # We're now ready to take the data we've captured and _transmit_ it.
+                    # We'll toggle our data PID for the new packet.
+                    m.d.usb += self.data_pid[0].eq(~self.data_pid[0])
 
 
             # WAIT_TO_SEND -- we now have at least a buffer full of data to send; we'll
@@ -297,8 +329,6 @@ class USBInTransferManager(Elaboratable):
 
                 # If the host does ACK...
                 with m.If(self.handshakes_in.ack):
-                    # ... clear the data we've sent from our buffer.
-                    m.d.usb += read_fill_count.eq(0)
 
                     # Figure out if we'll need to follow up with a ZLP. If we have ZLP generation enabled,
                     # we'll make sure we end on a short packet. If this is max-packet-size packet _and_ our
@@ -306,26 +336,29 @@ class USBInTransferManager(Elaboratable):
                     follow_up_with_zlp = \
                         self.generate_zlps & (read_fill_count == self._max_packet_size) & read_stream_ended
 
-                    # If we're following up with a ZLP, move back to our "wait to send" state.
-                    # Since we've now cleared our fill count; this next go-around will emit a ZLP.
+                    # If we're following up with a ZLP, clear the data we've sent from our buffer, and move
+                    # back to our "wait to send" state. Since we've now cleared our fill count; this next
+                    # go-around will emit a ZLP. The ZLP is a new packet, so it gets a new data PID.
                     with m.If(follow_up_with_zlp):
+                        m.d.usb += [
+                            read_fill_count     .eq(0),
+                            self.data_pid[0]    .eq(~self.data_pid[0])
+                        ]
                         m.next = "WAIT_TO_SEND"
 
-                    # Otherwise, there's a possibility we already have a packet-worth of data waiting
-                    # for us in our "write buffer", which we've been filling in the background.
-                    # If this is the case, we'll flip which buffer we're working with, toggle our data pid,
-                    # and then ready ourselves for transmit.
-                    packet_completing = in_stream.valid & (write_fill_count + 1 == self._max_packet_size)
-                    with m.Elif(~in_stream.ready | packet_completing):
+                    # Otherwise, we're done with this buffer; and there's a possibility we already have
+                    # a packet-worth of data waiting for us in our next buffer, which we've been filling
+                    # in the background. If this is the case, we'll toggle our data pid, and then ready
+                    # ourselves for transmit.
+                    with m.Elif(packet_enqueuing | (buffers_filled > 1)):
+                        m.d.comb += packet_releasing.eq(1)
+                        m.d.usb  += self.data_pid[0].eq(~self.data_pid[0])
                         m.next = "WAIT_TO_SEND"
-                        m.d.usb += [
-                            self.data_pid[0]   .eq(~self.data_pid[0]),
-                            read_stream_ended  .eq(0)
-                        ]
 
                     # If neither of the above conditions are true; we now don't have enough data to send.
                     # We'll wait for enough data to transmit.
                     with m.Else():
+                        m.d.comb += packet_releasing.eq(1)
                         m.next = "WAIT_FOR_DATA"
 
 
@@ -537,5 +570,246 @@ class USBInTransferManagerTest(LunaGatewareTestCase):
         self.assertEqual((yield transfer_stream.ready), 1)
 
 
+class USBInTransferManagerQuadBufferTest(LunaGatewareTestCase):
+    FRAGMENT_UNDER_TEST = USBInTransferManager
+    FRAGMENT_ARGUMENTS  = {"max_packet_size": 4, "num_buffers": 4}
+
+    SYNC_CLOCK_FREQUENCY = None
+    USB_CLOCK_FREQUENCY = 60e6
+
+    def initialize_signals(self):
+        yield self.dut.packet_stream.ready.eq(1)
+        yield self.dut.active.eq(1)
+        yield self.dut.tokenizer.is_in.eq(1)
+
+
+    @usb_domain_test_case
+    def test_packet_queueing(self):
+        dut = self.dut
+
+        packet_stream   = dut.packet_stream
+        transfer_stream = dut.transfer_stream
+
+        # We should be able to queue up a full packet into each of our four buffers...
+        yield transfer_stream.valid.eq(1)
+        for value in range(16):
+            self.assertEqual((yield transfer_stream.ready), 1)
+            yield transfer_stream.payload.eq(value)
+            yield
+        yield transfer_stream.valid.eq(0)
+
+        # ... after which we should no longer be accepting data.
+        yield
+        self.assertEqual((yield transfer_stream.ready), 0)
+
+        # Each of our packets should then be sent in order, with alternating PIDs...
+        for packet in range(4):
+            yield from self.pulse(dut.tokenizer.ready_for_response, step_after=False)
+            self.assertEqual((yield dut.data_pid), packet % 2)
+            yield
+
+            for value in range(packet * 4, packet * 4 + 4):
+                self.assertEqual((yield packet_stream.payload), value)
+                yield
+
+            # ... and each ACK should free up a buffer for new data.
+            yield from self.pulse(dut.handshakes_in.ack)
+            self.assertEqual((yield transfer_stream.ready), 1)
+
+
+    @usb_domain_test_case
+    def test_retransmit_with_queued_packets(self):
+        dut = self.dut
+
+        packet_stream   = dut.packet_stream
+        transfer_stream = dut.transfer_stream
+
+        # Queue up three packets' worth of data.
+        yield transfer_stream.valid.eq(1)
+        for value in range(12):
+            yield transfer_stream.payload.eq(value)
+            yield
+        yield transfer_stream.valid.eq(0)
+        yield
+
+        # Send our first packet...
+        yield from self.pulse(dut.tokenizer.ready_for_response, step_after=False)
+        self.assertEqual((yield dut.data_pid), 0)
+        yield
+        for value in range(4):
+            self.assertEqual((yield packet_stream.payload), value)
+            yield
+
+        # ... but don't ACK it; and instead have the host start a new transaction.
+        yield from self.pulse(dut.tokenizer.new_token)
+        yield
+
+        # We should see the same packet re-sent, with the same PID; rather than any of our queued packets.
+        yield from self.pulse(dut.tokenizer.ready_for_response, step_after=False)
+        self.assertEqual((yield dut.data_pid), 0)
+        yield
+        for value in range(4):
+            self.assertEqual((yield packet_stream.payload), value)
+            yield
+
+        # Once that packet is finally ACK'd, our queued packets should follow in order.
+        yield from self.pulse(dut.handshakes_in.ack)
+
+        for packet in range(1, 3):
+            yield from self.pulse(dut.tokenizer.ready_for_response, step_after=False)
+            self.assertEqual((yield dut.data_pid), packet % 2)
+            yield
+
+            for value in range(packet * 4, packet * 4 + 4):
+                self.assertEqual((yield packet_stream.payload), value)
+                yield
+
+            yield from self.pulse(dut.handshakes_in.ack)
+
+        # ... after which we should have nothing left to send.
+        yield from self.pulse(dut.tokenizer.ready_for_response, step_after=False)
+        self.assertEqual((yield dut.handshakes_out.nak), 1)
+
+
+    @usb_domain_test_case
+    def test_zlp_with_queued_packet(self):
+        dut = self.dut
+
+        packet_stream   = dut.packet_stream
+        transfer_stream = dut.transfer_stream
+
+        yield dut.generate_zlps.eq(1)
+
+        # Queue up a full packet that ends our transfer...
+        yield transfer_stream.valid.eq(1)
+        for value in range(4):
+            yield transfer_stream.payload.eq(value)
+            yield transfer_stream.last.eq(value == 3)
+            yield
+
+        # ... followed by a short packet that ends our next transfer.
+        for value in range(4, 6):
+            yield transfer_stream.payload.eq(value)
+            yield transfer_stream.last.eq(value == 5)
+            yield
+        yield transfer_stream.last.eq(0)
+        yield transfer_stream.valid.eq(0)
+        yield
+
+        # We should first see our full packet...
+        yield from self.pulse(dut.tokenizer.ready_for_response, step_after=False)
+        self.assertEqual((yield dut.data_pid), 0)
+        yield
+        for value in range(4):
+            self.assertEqual((yield packet_stream.payload), value)
+            self.assertEqual((yield packet_stream.last), value == 3)
+            yield
+        yield from self.pulse(dut.handshakes_in.ack)
+
+        # ... then a ZLP, as its own packet; rather than our queued data...
+        yield from self.pulse(dut.tokenizer.ready_for_response, step_after=False)
+        self.assertEqual((yield dut.data_pid), 1)
+        self.assertEqual((yield packet_stream.valid), 1)
+        self.assertEqual((yield packet_stream.last), 1)
+        yield
+        self.assertEqual((yield packet_stream.valid), 0)
+        yield from self.pulse(dut.handshakes_in.ack)
+
+        # ... and only then our queued short packet.
+        yield from self.pulse(dut.tokenizer.ready_for_response, step_after=False)
+        self.assertEqual((yield dut.data_pid), 0)
+        yield
+        for value in range(4, 6):
+            self.assertEqual((yield packet_stream.payload), value)
+            self.assertEqual((yield packet_stream.last), value == 5)
+            yield
+        yield from self.pulse(dut.handshakes_in.ack)
+
+        # Since that packet was short, no ZLP should follow it.
+        yield from self.pulse(dut.tokenizer.ready_for_response, step_after=False)
+        self.assertEqual((yield dut.handshakes_out.nak), 1)
+        self.assertEqual((yield packet_stream.valid), 0)
+
+
+class USBInTransferManagerTripleBufferTest(LunaGatewareTestCase):
+    FRAGMENT_UNDER_TEST = USBInTransferManager
+    FRAGMENT_ARGUMENTS  = {"max_packet_size": 4, "num_buffers": 3}
+
+    SYNC_CLOCK_FREQUENCY = None
+    USB_CLOCK_FREQUENCY = 60e6
+
+    def initialize_signals(self):
+        yield self.dut.packet_stream.ready.eq(1)
+        yield self.dut.active.eq(1)
+        yield self.dut.tokenizer.is_in.eq(1)
+
+
+    @usb_domain_test_case
+    def test_ring_wraparound(self):
+        dut = self.dut
+
+        packet_stream   = dut.packet_stream
+        transfer_stream = dut.transfer_stream
+
+        # Fill each of our three buffers...
+        yield transfer_stream.valid.eq(1)
+        for value in range(12):
+            self.assertEqual((yield transfer_stream.ready), 1)
+            yield transfer_stream.payload.eq(value)
+            yield
+        yield transfer_stream.valid.eq(0)
+
+        # ... after which we should no longer be accepting data.
+        yield
+        self.assertEqual((yield transfer_stream.ready), 0)
+
+        # Send and ACK our first packet, freeing up our first buffer.
+        yield from self.pulse(dut.tokenizer.ready_for_response, step_after=False)
+        self.assertEqual((yield dut.data_pid), 0)
+        yield
+        for value in range(4):
+            self.assertEqual((yield packet_stream.payload), value)
+            yield
+        yield from self.pulse(dut.handshakes_in.ack)
+
+        # We should now be able to fill that buffer again; which requires our write position
+        # to wrap around from our last buffer to our first.
+        yield transfer_stream.valid.eq(1)
+        for value in range(12, 16):
+            self.assertEqual((yield transfer_stream.ready), 1)
+            yield transfer_stream.payload.eq(value)
+            yield
+        yield transfer_stream.valid.eq(0)
+        yield
+        self.assertEqual((yield transfer_stream.ready), 0)
+
+        # Our remaining packets should then be sent in order, with our read position
+        # wrapping around the same way.
+        for packet in range(1, 4):
+            yield from self.pulse(dut.tokenizer.ready_for_response, step_after=False)
+            self.assertEqual((yield dut.data_pid), packet % 2)
+            yield
+
+            for value in range(packet * 4, packet * 4 + 4):
+                self.assertEqual((yield packet_stream.payload), value)
+                yield
+
+            yield from self.pulse(dut.handshakes_in.ack)
+            self.assertEqual((yield transfer_stream.ready), 1)
+
+        # Once we've drained every buffer, we should have nothing left to send.
+        yield from self.pulse(dut.tokenizer.ready_for_response, step_after=False)
+        self.assertEqual((yield dut.handshakes_out.nak), 1)
+
+
+class USBInTransferManagerParameterTest(unittest.TestCase):
+
+    def test_num_buffers_must_be_supported(self):
+        for num_buffers in (1, 5):
+            with self.subTest(num_buffers=num_buffers):
+                with self.assertRaises(ValueError):
+                    USBInTransferManager(max_packet_size=4, num_buffers=num_buffers)
+
+
 if __name__ == "__main__":
     unittest.main()